@@ -0,0 +1,28 @@
+"""Cache su disco per le conversioni Markdown -> DOCX.
+
+A parita' di input la conversione e' deterministica, quindi una cache
+indicizzata dallo SHA-256 del testo trasforma una richiesta ripetuta
+(tipica quando un agente ritenta o rigenera) in una semplice copia di file.
+
+Il server converte su file temporaneo e pubblica in cache con `store`;
+il percorso dell'eventuale voce esistente lo fornisce `cache_file`.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+# Directory radice della cache, con una sottocartella per estensione
+_CACHE_ROOT = Path(".mcp-convert-cache")
+
+
+def cache_file(body: str, ext: str) -> Path:
+    """Restituisce il percorso in cache per il contenuto e l'estensione dati."""
+    key = hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+    return _CACHE_ROOT / ext / f"{key}.{ext}"
+
+
+def store(cached_path: Path, src_path: str) -> None:
+    """Pubblica atomicamente un file appena convertito nella cache."""
+    cached_path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(src_path, cached_path)
@@ -1,8 +1,22 @@
+import asyncio
+import base64
+import hashlib
 import os
+import pathlib
+import re
+import shutil
+import socket
+import tempfile
 from typing import Annotated
 
-# Import necessari da Pydantic per definire i parametri
-from pydantic import BaseModel, Field
+# Cache su disco delle conversioni gia' eseguite
+from .cache import cache_file, store
+
+# Client HTTP usato per dialogare con il processo `pandoc server`
+import httpx
+
+# Import necessari da Pydantic per definire e validare i parametri
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 
 # Import necessari dal framework MCP per creare il server
 from mcp.server import Server
@@ -10,8 +24,168 @@ from mcp.server.stdio import stdio_server
 from mcp.shared.exceptions import McpError
 from mcp.types import Tool, ErrorData, TextContent, INTERNAL_ERROR, INVALID_PARAMS
 
-# Import dalla libreria per creare file DOCX
-import pypandoc
+# Percorso del binario pandoc, risolto una sola volta all'import del modulo.
+# Invocare pandoc direttamente evita i probe `--list-input-formats` /
+# `--list-output-formats` che pypandoc lancia ad ogni conversione.
+_PANDOC_BIN = shutil.which("pandoc") or "pandoc"
+
+# Cartella di destinazione dei DOCX generati: risolta una sola volta
+# all'import e creata all'avvio del server, non ad ogni richiesta
+_OUTPUT_DIR = pathlib.Path("output").resolve()
+
+# --- Stato del processo `pandoc server` persistente ---
+# Tenere pandoc "caldo" tra una richiesta e l'altra ammortizza il costo fisso
+# di avvio del runtime Haskell su tutte le conversioni della sessione.
+_pandoc_proc: asyncio.subprocess.Process | None = None
+# Client HTTP riusato per tutte le richieste al server pandoc: e' anche il
+# segnale che il server e' attivo (None = ripiegare sul one-shot)
+_pandoc_client: httpx.AsyncClient | None = None
+
+# Tempo massimo concesso a una singola conversione, in secondi. Il server
+# pandoc di suo taglia a 2 secondi, troppo poco per documenti grandi; lo
+# stesso limite (con margine) vale per la chiamata HTTP corrispondente.
+_PANDOC_TIMEOUT = 300
+
+
+def _free_port() -> int:
+    """Chiede al sistema operativo una porta TCP libera su localhost."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _start_pandoc_server() -> None:
+    """Avvia `pandoc server` come processo figlio e attende che sia pronto."""
+    global _pandoc_proc, _pandoc_client
+    port = _free_port()
+    try:
+        _pandoc_proc = await asyncio.create_subprocess_exec(
+            _PANDOC_BIN, "server", "--port", str(port),
+            "--timeout", str(_PANDOC_TIMEOUT),
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError:
+        # pandoc non disponibile: si ripiega sulla conversione one-shot
+        _pandoc_proc = None
+        return
+
+    url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient() as client:
+        for _ in range(50):
+            if _pandoc_proc.returncode is not None:
+                # Il processo e' morto subito (es. versione senza modo server)
+                _pandoc_proc = None
+                return
+            try:
+                await client.get(f"{url}/version")
+                # Un unico client di lunga vita: la connessione riusata evita
+                # l'handshake TCP per richiesta; il timeout esplicito lascia
+                # al server il margine per completare conversioni lunghe
+                _pandoc_client = httpx.AsyncClient(
+                    base_url=url, timeout=_PANDOC_TIMEOUT + 10
+                )
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+
+    # Il server non ha risposto in tempo: si ripiega sulla conversione one-shot
+    _pandoc_proc.terminate()
+    _pandoc_proc = None
+
+
+async def _stop_pandoc_server() -> None:
+    """Termina il processo `pandoc server`, se attivo."""
+    global _pandoc_proc, _pandoc_client
+    if _pandoc_client is not None:
+        await _pandoc_client.aclose()
+        _pandoc_client = None
+    if _pandoc_proc is not None and _pandoc_proc.returncode is None:
+        _pandoc_proc.terminate()
+        await _pandoc_proc.wait()
+    _pandoc_proc = None
+
+
+# Tabella di traduzione precompilata per normalizzare i nomi file:
+# un'unica passata in C invece di una catena di replace
+_FILENAME_TRANS = str.maketrans({" ": "_", "/": "_", "\\": "_", ":": "_"})
+
+
+def _safe_filename(filename: str) -> str:
+    """Normalizza il nome file richiesto e blocca i tentativi di path traversal."""
+    if ".." in filename:
+        raise McpError(ErrorData(code=INVALID_PARAMS, message=f"Nome file non valido: {filename}"))
+    return os.path.basename(filename).translate(_FILENAME_TRANS).lower()
+
+
+# --- Pre-elaborazione del Markdown in ingresso ---
+# Blocchi HTML che pandoc non puo' rendere in DOCX e che gonfiano solo l'input
+_HTML_NOISE = re.compile(
+    r"<script\b.*?</script>|<style\b.*?</style>|<!--.*?-->",
+    re.IGNORECASE | re.DOTALL,
+)
+# Immagini inline codificate base64: ![alt](data:image/png;base64,....)
+_DATA_URI_IMAGE = re.compile(
+    r"(!\[[^\]]*\]\()data:image/(\w+);base64,([A-Za-z0-9+/=\s]+?)(\))"
+)
+# Tre o piu' righe vuote consecutive
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+# Blocchi di codice recintati (``` o ~~~): il loro contenuto va mostrato
+# cosi' com'e' nel DOCX e non deve essere toccato dalla pre-elaborazione
+_FENCED_BLOCK = re.compile(r"^(```|~~~).*?^\1[ \t]*$", re.MULTILINE | re.DOTALL)
+
+# Cartella dove vengono estratte le immagini inline, indicizzate per hash
+_MEDIA_DIR = os.path.join(_OUTPUT_DIR, "media")
+
+
+def _extract_data_uri(match: re.Match) -> str:
+    """Scrive un'immagine base64 su disco e la sostituisce con il suo percorso.
+
+    Il file e' indicizzato per hash del contenuto, quindi la stessa immagine
+    ripetuta viene scritta una volta sola e pandoc la legge in binario invece
+    di decodificare il data-URI per ogni occorrenza.
+    """
+    payload = match.group(3)
+    try:
+        data = base64.b64decode(payload)
+    except ValueError:
+        # Base64 malformato: si lascia il data-URI com'era
+        return match.group(0)
+    name = hashlib.sha1(data).hexdigest() + "." + match.group(2)
+    path = os.path.join(_MEDIA_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(_MEDIA_DIR, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+    return match.group(1) + path + match.group(4)
+
+
+def _clean_segment(segment: str) -> str:
+    """Applica le sostituzioni di alleggerimento a un tratto fuori dai blocchi di codice."""
+    segment = _HTML_NOISE.sub("", segment)
+    segment = _DATA_URI_IMAGE.sub(_extract_data_uri, segment)
+    return _BLANK_LINES.sub("\n\n", segment)
+
+
+def _preprocess_markdown(text: str) -> str:
+    """Alleggerisce il Markdown prima di passarlo a pandoc.
+
+    Rimuove script/style/commenti HTML che non finiscono comunque nel DOCX,
+    estrae le immagini base64 su file locali e comprime le righe vuote in
+    eccesso: tutto cio' riduce sensibilmente la memoria usata da pandoc su
+    input prodotti dagli agenti. I blocchi di codice recintati vengono
+    lasciati intatti: li' script, commenti e righe vuote sono contenuto
+    da mostrare, non rumore.
+    """
+    parts = []
+    last = 0
+    for fence in _FENCED_BLOCK.finditer(text):
+        parts.append(_clean_segment(text[last:fence.start()]))
+        parts.append(fence.group(0))
+        last = fence.end()
+    parts.append(_clean_segment(text[last:]))
+    return "".join(parts)
 
 
 # --- Definizione dei Parametri dello Strumento ---
@@ -28,22 +202,104 @@ class CreateDocxParams(BaseModel):
     ]
 
 
+# Lo schema JSON dei parametri e' statico: lo si genera una sola volta
+# all'import invece che ad ogni chiamata di list_tools
+_CREATE_DOCX_SCHEMA = CreateDocxParams.model_json_schema()
+
+# Adapter riusato per validare i parametri di ogni chiamata: il core schema
+# viene costruito una volta sola invece che ripassare dal costruttore del modello
+_DOCX_ADAPTER = TypeAdapter(CreateDocxParams)
+
+
+def _write_bytes(path: str, data: bytes) -> None:
+    """Scrive i byte su file in un'unica chiamata."""
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _publish_output(src, output_path: str) -> None:
+    """Copia un file sul percorso di output con pubblicazione atomica.
+
+    La copia passa da un file temporaneo seguito da un unico rename, cosi'
+    nessun lettore vede mai un DOCX parziale sul percorso finale.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=_OUTPUT_DIR, suffix=".docx.tmp")
+    os.close(fd)
+    shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, output_path)
+
+
 # --- Logica di Business: Creazione del File DOCX ---
-def create_docx_file(filename: str, text_content: str) -> str:
+async def create_docx_file(filename: str, text_content: str) -> str:
     """Crea un file DOCX convertendo il testo Markdown usando Pandoc."""
-    os.makedirs("output", exist_ok=True)
-    if not filename.lower().endswith(".docx"):
+    filename = _safe_filename(filename)
+    if not filename.endswith(".docx"):
         filename += ".docx"
-    output_path = os.path.join("output", filename)
+    output_path = os.path.join(_OUTPUT_DIR, filename)
+
+    # Alleggerisce l'input prima di tutto, cosi' anche la chiave di cache
+    # viene calcolata sul testo normalizzato
+    text_content = _preprocess_markdown(text_content)
 
     try:
-        # Usa pypandoc per convertire il Markdown direttamente in un file DOCX
-        pypandoc.convert_text(
-            source=text_content,
-            format='markdown',
-            to='docx',
-            outputfile=output_path
-        )
+        # Conversione gia' in cache: basta copiare il file sul percorso di
+        # output; la copia avviene in un thread per non bloccare l'event loop
+        cached = cache_file(text_content, "docx")
+        if cached.exists():
+            await asyncio.to_thread(_publish_output, cached, output_path)
+            return f"File DOCX creato con successo (via Pandoc) in: {output_path}"
+
+        # Converte su un file temporaneo accanto alla cache, poi lo pubblica
+        # in cache con un rename atomico e infine lo copia sull'output
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cached.parent, suffix=".tmp")
+        os.close(fd)
+        try:
+            converted = False
+            if _pandoc_client is not None:
+                # Conversione tramite il processo `pandoc server` persistente:
+                # niente fork/exec per richiesta, solo una POST su localhost
+                # con il client riusato per tutta la sessione
+                try:
+                    response = await _pandoc_client.post(
+                        "/",
+                        json={"text": text_content, "from": "markdown", "to": "docx"},
+                        headers={"Accept": "application/json"},
+                    )
+                    response.raise_for_status()
+                    # I formati binari vengono restituiti codificati in base64
+                    docx_bytes = base64.b64decode(response.json()["output"])
+                    await asyncio.to_thread(_write_bytes, tmp_path, docx_bytes)
+                    converted = True
+                except httpx.HTTPError:
+                    # Server pandoc in difficolta' (timeout, errore HTTP):
+                    # la richiesta ripiega sul percorso one-shot qui sotto
+                    pass
+            if not converted:
+                # Ripiego one-shot: il Markdown viene passato a pandoc via stdin
+                # (niente file temporaneo di input) mentre il DOCX viene scritto
+                # direttamente sul file di destinazione; il processo e' asincrono
+                # cosi' l'event loop resta libero durante la conversione
+                proc = await asyncio.create_subprocess_exec(
+                    _PANDOC_BIN, "-f", "markdown", "-t", "docx", "-o", tmp_path,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await proc.communicate(text_content.encode("utf-8"))
+                if proc.returncode != 0:
+                    raise RuntimeError(stderr.decode("utf-8", errors="replace").strip())
+            await asyncio.to_thread(store, cached, tmp_path)
+        except Exception:
+            # Conversione fallita: il file temporaneo non verra' mai
+            # pubblicato in cache, quindi va eliminato per non accumulare
+            # orfani dentro .mcp-convert-cache
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        await asyncio.to_thread(_publish_output, cached, output_path)
         return f"File DOCX creato con successo (via Pandoc) in: {output_path}"
     except Exception as e:
         raise McpError(ErrorData(code=INTERNAL_ERROR, message=f"Errore durante la creazione del DOCX con Pandoc: {e}"))
@@ -62,7 +318,7 @@ async def serve() -> None:
             Tool(
                 name="create_docx",
                 description="Crea un file DOCX editabile a partire da un testo in Markdown.",
-                inputSchema=CreateDocxParams.model_json_schema(),
+                inputSchema=_CREATE_DOCX_SCHEMA,
             )
         ]
 
@@ -70,16 +326,25 @@ async def serve() -> None:
     @server.call_tool()
     async def call_tool(name: str, arguments: dict) -> list[TextContent]:
         try:
-            args = CreateDocxParams(**arguments)
-        except ValueError as e:
+            args = _DOCX_ADAPTER.validate_python(arguments)
+        except ValidationError as e:
             raise McpError(ErrorData(code=INVALID_PARAMS, message=f"Parametri invalidi: {e}"))
         
         # Chiama la funzione che crea il file DOCX
-        result_message = create_docx_file(args.filename, args.text_content)
+        result_message = await create_docx_file(args.filename, args.text_content)
 
         return [TextContent(type="text", text=result_message)]
 
-    # Avvia il server e lo mette in ascolto
-    options = server.create_initialization_options()
-    async with stdio_server() as (read_stream, write_stream):
-        await server.run(read_stream, write_stream, options)
\ No newline at end of file
+    # Crea la cartella di output una volta sola all'avvio, togliendo la
+    # makedirs (e la sua stat) dal percorso caldo di ogni richiesta
+    os.makedirs(_OUTPUT_DIR, exist_ok=True)
+
+    # Avvia il processo pandoc persistente, poi il server MCP in ascolto;
+    # alla chiusura il processo figlio viene terminato in ogni caso
+    await _start_pandoc_server()
+    try:
+        options = server.create_initialization_options()
+        async with stdio_server() as (read_stream, write_stream):
+            await server.run(read_stream, write_stream, options)
+    finally:
+        await _stop_pandoc_server()
\ No newline at end of file
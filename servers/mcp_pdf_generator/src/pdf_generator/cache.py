@@ -0,0 +1,51 @@
+"""Cache su disco per le conversioni Markdown -> PDF.
+
+A parita' di input la conversione e' deterministica, quindi una cache
+indicizzata dallo SHA-256 del testo trasforma una richiesta ripetuta
+(tipica quando un agente ritenta o rigenera) in una lettura di file.
+
+Il server passa da `cached_convert`, che incapsula lookup, conversione
+e pubblicazione atomica della voce di cache.
+"""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable
+
+# Directory radice della cache, con una sottocartella per estensione
+_CACHE_ROOT = Path(".mcp-convert-cache")
+
+
+def _cache_file(body: str, ext: str) -> Path:
+    """Restituisce il percorso in cache per il contenuto e l'estensione dati."""
+    key = hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+    return _CACHE_ROOT / ext / f"{key}.{ext}"
+
+
+def cached_convert(body: str, ext: str, producer: Callable[[str], bytes]) -> bytes:
+    """Restituisce i byte del documento convertito, usando la cache se possibile.
+
+    In caso di miss invoca `producer` e salva il risultato in cache con una
+    scrittura atomica (file temporaneo + rename); se la scrittura fallisce
+    il file temporaneo viene eliminato per non lasciare orfani.
+    """
+    cached = _cache_file(body, ext)
+    if cached.exists():
+        return cached.read_bytes()
+
+    data = producer(body)
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cached.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, cached)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return data
@@ -1,8 +1,21 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import html
+import io
 import os
+import pathlib
+import re
+import sys
+import tempfile
 from typing import Annotated
 
-# Import necessari da Pydantic per definire i parametri dello strumento
-from pydantic import BaseModel, Field
+# Cache su disco delle conversioni gia' eseguite
+from .cache import cached_convert
+
+# Import necessari da Pydantic per definire e validare i parametri dello strumento
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 
 # Import necessari dal framework MCP per creare il server
 from mcp.server import Server
@@ -13,6 +26,24 @@ from mcp.types import Tool, ErrorData, TextContent, INTERNAL_ERROR, INVALID_PARA
 import markdown2
 from xhtml2pdf import pisa
 
+# Backend di rendering nativo opzionale: WeasyPrint appoggia il rendering su
+# librerie C (Pango/Cairo) ed e' molto piu' veloce del percorso pure-Python
+# di xhtml2pdf su documenti con tabelle o immagini. Se manca il pacchetto o
+# le sue librerie native, si continua a usare pisa. L'import avviene con
+# stdout dirottato su stderr: su stdout passa il protocollo MCP e il banner
+# che WeasyPrint stampa quando mancano le librerie native lo corromperebbe.
+try:
+    with contextlib.redirect_stdout(sys.stderr):
+        import weasyprint
+except (ImportError, OSError):
+    weasyprint = None
+
+# Impostare PDF_GENERATOR_BACKEND=pisa forza il vecchio backend xhtml2pdf
+_USE_WEASYPRINT = (
+    weasyprint is not None
+    and os.environ.get("PDF_GENERATOR_BACKEND", "weasyprint") != "pisa"
+)
+
 
 # --- Definizione dei Parametri dello Strumento ---
 class CreatePdfParams(BaseModel):
@@ -28,31 +59,131 @@ class CreatePdfParams(BaseModel):
     ]
 
 
+# Lo schema JSON dei parametri e' statico: lo si genera una sola volta
+# all'import invece che ad ogni chiamata di list_tools
+_CREATE_PDF_SCHEMA = CreatePdfParams.model_json_schema()
+
+# Adapter riusato per validare i parametri di ogni chiamata: il core schema
+# viene costruito una volta sola invece che ripassare dal costruttore del modello
+_PDF_ADAPTER = TypeAdapter(CreatePdfParams)
+
+
+# Cartella di destinazione dei PDF generati: risolta una sola volta
+# all'import e creata all'avvio del server, non ad ogni richiesta
+_OUTPUT_DIR = pathlib.Path("output").resolve()
+
+# Pool di processi per le conversioni: pisa.CreatePDF tiene il GIL per buona
+# parte del lavoro e xhtml2pdf non e' thread-safe, quindi si usano processi
+# separati per non bloccare l'event loop e scalare sui core disponibili
+_EXECUTOR = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+
+# Le extras markdown2 usate per ogni conversione
+_MD_EXTRAS = ("tables", "fenced-code-blocks")
+
+# Istanza condivisa del renderer markdown2: costruirne una nuova ad ogni
+# chiamata ri-analizza la lista di extras e re-istanzia i postprocessor.
+# Il suo stato interno (html_blocks, riferimenti, ecc.) viene azzerato con
+# reset() prima di ogni conversione, evitando accumuli tra richieste.
+_MD = markdown2.Markdown(extras=list(_MD_EXTRAS))
+
+# Sintassi Markdown da riconoscere prima di scartare il parser: marcatori
+# inline, elenchi puntati e numerati a inizio riga, sottolineature setext.
+# Un falso positivo fa solo girare markdown2 su testo semplice (innocuo);
+# un falso negativo renderebbe markdown valido come blocco <pre> letterale.
+_MD_SYNTAX = re.compile(
+    r"[#*_`\[\]>|]"              # marcatori inline (enfasi, titoli ATX, link...)
+    r"|^[ \t]*[-+][ \t]"         # elenchi puntati con - o +
+    r"|^[ \t]*\d+\.[ \t]"        # elenchi numerati (1. 2. ...)
+    r"|^[=-]+[ \t]*$",           # sottolineature setext (=== / ---)
+    re.MULTILINE,
+)
+
+# Tabella di traduzione precompilata per normalizzare i nomi file:
+# un'unica passata in C invece di una catena di replace
+_FILENAME_TRANS = str.maketrans({" ": "_", "/": "_", "\\": "_", ":": "_"})
+
+
+def _safe_filename(filename: str) -> str:
+    """Normalizza il nome file richiesto e blocca i tentativi di path traversal.
+
+    Solleva ValueError (non McpError) perche' viene eseguita anche nei processi
+    del pool: un'eccezione non ricostruibile dal pickling romperebbe l'executor.
+    """
+    if ".." in filename:
+        raise ValueError(f"Nome file non valido: {filename}")
+    return os.path.basename(filename).translate(_FILENAME_TRANS).lower()
+
+
+def _render_pdf(html_content: str) -> bytes:
+    """Rende l'HTML in PDF con il backend disponibile piu' veloce."""
+    if _USE_WEASYPRINT:
+        return weasyprint.HTML(string=html_content).write_pdf()
+
+    buffer = io.BytesIO()
+    pisa_status = pisa.CreatePDF(
+        src=html_content,    # Il contenuto HTML da convertire
+        dest=buffer          # Il buffer dove scrivere il PDF
+    )
+
+    if pisa_status.err:
+        raise RuntimeError("Errore durante la conversione da HTML a PDF.")
+
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=512)
+def _md_to_html(text: str) -> str:
+    """Converte Markdown in HTML, memorizzando i risultati piu' recenti.
+
+    La conversione e' deterministica, quindi un testo gia' visto (tipico per
+    template ripetuti) viene servito dalla cache senza rieseguire il parser.
+    """
+    _MD.reset()
+    return _MD.convert(text)
+
+
 # --- Questa è la funzione che crea il PDF ---
+# Gira nei processi del pool: deve sollevare solo eccezioni standard
+# (picklabili); la traduzione in McpError avviene in call_tool, nel padre.
 def create_pdf_file(filename: str, text_content: str) -> str:
     """Crea un file PDF convertendo il testo Markdown in HTML."""
 
-    os.makedirs("output", exist_ok=True)
-    output_path = os.path.join("output", filename)
+    filename = _safe_filename(filename)
+    output_path = os.path.join(_OUTPUT_DIR, filename)
 
-    try:
-        # 1. Converte il testo Markdown in HTML
-        html_content = markdown2.markdown(text_content, extras=["tables", "fenced-code-blocks"])
-
-        # 2. Scrive il PDF partendo dall'HTML
-        with open(output_path, "w+b") as pdf_file:
-            pisa_status = pisa.CreatePDF(
-                src=html_content,    # Il contenuto HTML da convertire
-                dest=pdf_file        # L'oggetto file dove scrivere il PDF
-            )
+    def produce_pdf(body: str) -> bytes:
+        # 1. Converte il testo Markdown in HTML, saltando il parser
+        #    quando l'input e' gia' HTML o testo semplice senza markup
+        if body.lstrip().startswith("<") and "</" in body:
+            html_content = body
+        elif _MD_SYNTAX.search(body) is None:
+            html_content = "<pre>" + html.escape(body) + "</pre>"
+        else:
+            html_content = _md_to_html(body)
 
-        if pisa_status.err:
-            raise McpError(ErrorData(code=INTERNAL_ERROR, message="Errore durante la conversione da HTML a PDF."))
+        # 2. Rende l'HTML in PDF con il backend configurato
+        return _render_pdf(html_content)
 
-        return f"File PDF creato con successo da Markdown in: {output_path}"
+    # Riusa la conversione in cache se lo stesso testo e' gia' stato reso
+    pdf_bytes = cached_convert(text_content, "pdf", produce_pdf)
 
-    except Exception as e:
-        raise McpError(ErrorData(code=INTERNAL_ERROR, message=f"Errore durante la creazione del PDF: {e}"))
+    # Pubblicazione atomica: un'unica scrittura su file temporaneo seguita
+    # da un rename, cosi' nessun lettore vede mai un PDF parziale
+    fd, tmp_path = tempfile.mkstemp(dir=_OUTPUT_DIR, suffix=".pdf.tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(pdf_bytes)
+        os.replace(tmp_path, output_path)
+    except Exception:
+        # Scrittura o rename falliti: si elimina il file temporaneo per
+        # non accumulare orfani dentro output/
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    return f"File PDF creato con successo da Markdown in: {output_path}"
 
 
 # --- Logica del Server MCP ---
@@ -70,7 +201,7 @@ async def serve() -> None:
                 name="create_pdf",
                 description="Crea un file PDF con un testo specifico e lo salva.",
                 # Specifica che i parametri di input devono rispettare lo schema definito prima
-                inputSchema=CreatePdfParams.model_json_schema(),
+                inputSchema=_CREATE_PDF_SCHEMA,
             )
         ]
 
@@ -80,16 +211,35 @@ async def serve() -> None:
     async def call_tool(name: str, arguments: dict) -> list[TextContent]:
         # Valida gli argomenti ricevuti da Claude usando il nostro schema Pydantic
         try:
-            args = CreatePdfParams(**arguments)
-        except ValueError as e:
+            args = _PDF_ADAPTER.validate_python(arguments)
+        except ValidationError as e:
             raise McpError(ErrorData(code=INVALID_PARAMS, message=f"Parametri invalidi: {e}"))
 
-        # Esegue la funzione che crea il PDF
-        result_message = create_pdf_file(args.filename, args.text_content)
+        # Sanifica il nome file nel processo padre, cosi' un nome invalido
+        # viene rifiutato subito senza nemmeno passare dal pool
+        try:
+            filename = _safe_filename(args.filename)
+        except ValueError as e:
+            raise McpError(ErrorData(code=INVALID_PARAMS, message=str(e)))
+
+        # Esegue la conversione in un processo del pool, cosi' l'event loop
+        # resta libero di servire altre richieste durante il rendering; gli
+        # errori del worker arrivano come eccezioni standard e vengono
+        # tradotti in McpError qui
+        try:
+            result_message = await asyncio.get_running_loop().run_in_executor(
+                _EXECUTOR, create_pdf_file, filename, args.text_content
+            )
+        except Exception as e:
+            raise McpError(ErrorData(code=INTERNAL_ERROR, message=f"Errore durante la creazione del PDF: {e}"))
 
         # Restituisce il messaggio di successo a Claude
         return [TextContent(type="text", text=result_message)]
 
+    # Crea la cartella di output una volta sola all'avvio, togliendo la
+    # makedirs (e la sua stat) dal percorso caldo di ogni richiesta
+    os.makedirs(_OUTPUT_DIR, exist_ok=True)
+
     # Questa parte avvia il server e lo mette in ascolto di richieste
     # tramite Standard Input/Output, il canale di comunicazione usato da MCP.
     options = server.create_initialization_options()
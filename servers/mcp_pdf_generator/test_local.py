@@ -1,5 +1,6 @@
 # test_local.py
 import os
+import re
 from src.pdf_generator.server import create_pdf_file
 
 input_filename = "lutaro_story.md"
@@ -14,21 +15,21 @@ except FileNotFoundError:
     print(f"ERRORE: File '{input_filename}' non trovato. Crealo prima di eseguire il test.")
     exit()
 
-# Trova la prima riga che è un titolo per usarla come nome del file
-pdf_title = "documento_senza_titolo"
-for line in markdown_text.split('\n'):
-    stripped_line = line.strip()
-    if stripped_line.startswith('# '):
-        # Prende il testo dopo '# ', lo pulisce e lo usa come nome file
-        pdf_title = stripped_line[2:].strip().replace(' ', '_').lower()
-        break
-    elif stripped_line.startswith('## '):
-        pdf_title = stripped_line[3:].strip().replace(' ', '_').lower()
-        break
-### Aggiungere un caso in cui non ci sono titoli
+# Trova il primo titolo con una sola scansione regex dell'intero buffer
+# (niente split('\n') ne' un giro di interprete per ogni riga)
+match = re.search(r"^(#{1,6})\s+(.+?)\s*$", markdown_text, re.MULTILINE)
+if match:
+    # Prende il testo del titolo, lo pulisce e lo usa come nome file
+    pdf_title = re.sub(r"\s+", "_", match.group(2)).lower()
+else:
+    pdf_title = "documento_senza_titolo"
 
 print("Avvio del test di generazione PDF...")
 
+# La cartella di output viene creata dal server all'avvio: qui chiamiamo
+# la funzione direttamente, quindi va preparata a mano
+os.makedirs("output", exist_ok=True)
+
 # Chiama la funzione con i dati letti dal file
 risultato = create_pdf_file(
     filename=f"{pdf_title}.pdf",